@@ -1,15 +1,28 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from docx import Document
 import os
 import csv
-from openai import OpenAI
+from openai import AsyncOpenAI
 import time
+import asyncio
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import shelve
+import hashlib
+import atexit
+import json
+import orjson
+import numpy as np
 
 # Instantiate OpenAI client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
-# Initialize a new Word document
-document = Document()
+# Progress and errors are logged rather than printed so verbosity can be controlled
+logger = logging.getLogger("readwise")
 
 # Your Readwise API token from environment variables
 api_token = os.environ.get("READWISE")
@@ -17,35 +30,246 @@ api_token = os.environ.get("READWISE")
 # Set up the headers with your Readwise API token
 headers = {"Authorization": f"Token {api_token}"}
 
+# Maximum number of retries
+MAX_RETRIES = 5
+
+# Reuse connections to Readwise across requests instead of a new TLS handshake per call.
+# Transient errors are retried with exponential backoff, honouring Retry-After when sent.
+session = requests.Session()
+session.headers.update(headers)
+retry = Retry(
+    total=MAX_RETRIES,
+    backoff_factor=2,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "PATCH"],
+    respect_retry_after_header=True,
+)
+session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry))
+
 # CSV file to save the data
 csv_file = "Highlights_with_Tags.csv"
+docx_file = "Highlights_with_Tags.docx"
 success_log_file = "updated_highlights_log.txt"
+tag_cache_file = "tag_cache.db"
+embedding_cache_file = "embedding_cache.db"
+
+# Generated tags and embeddings are cached on disk so reruns don't ask OpenAI again
+tag_cache = shelve.open(tag_cache_file)
+atexit.register(tag_cache.close)
+embedding_cache = shelve.open(embedding_cache_file)
+atexit.register(embedding_cache.close)
+
+# Bump PROMPT_VERSION whenever the prompt changes so cached tags are regenerated
+OPENAI_MODEL = "gpt-4o-mini"
+PROMPT_VERSION = 4
+
+# Tags the model is allowed to choose from
+ALLOWED_TAGS = [
+    "Economics", "Technology", "Startups", "Science", "Physics", "Biology", "Chemistry",
+    "Entrepreneurship", "Liberalism", "Philosophy", "Environment", "Religion", "Politics",
+    "History", "Psychology", "Sociology", "Statistics", "United Kingdom", "Quotes", "Film",
+    "Music", "Marketing", "Personal Finance", "Design", "CBT", "Lifetips", "Europe",
+    "United States", "Critical Thinking", "IdPol", "Health", "Finance", "Agriculture",
+    "Productivity", "Literature",
+]
+ALLOWED_TAG_SET = frozenset(ALLOWED_TAGS)
+
+# The instructions never change between requests, so they live in the system message
+# where OpenAI's prompt caching can reuse them
+SYSTEM_PROMPT = (
+    "You tag highlights. The user sends numbered highlights. Generate up to 3 high-level "
+    "relevant tags for each. Tags should not have hashes. Use British English. They should be "
+    f"restricted to: {', '.join(ALLOWED_TAGS)}. Return a JSON object with a \"tags\" key holding "
+    "an array where element i is the array of tags for highlight i."
+)
+
+# Used once for highlights that came back without any valid tag
+STRICT_SYSTEM_PROMPT = (
+    f"{SYSTEM_PROMPT} Every highlight must get at least one tag, and every tag must be copied "
+    "exactly as written from the list above."
+)
+
+# Structured output schema that only admits tags from the allowlist
+TAGS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "highlight_tags",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "tags": {
+                    "type": "array",
+                    "items": {"type": "array", "items": {"type": "string", "enum": ALLOWED_TAGS}},
+                },
+            },
+            "required": ["tags"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Embeddings used to match CSV highlights whose text no longer matches Readwise exactly
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_BATCH_SIZE = 2048
+# The endpoint caps a request at about 300k tokens and an input at 8191 tokens. Characters
+# are a conservative stand-in for tokens, since a token is rarely shorter than one character.
+EMBEDDING_MAX_BATCH_CHARS = 250_000
+EMBEDDING_MAX_INPUT_CHARS = 8_000
+SIMILARITY_THRESHOLD = 0.92
+
+# Maximum number of OpenAI requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Number of highlights tagged per OpenAI request
+BATCH_SIZE = 20
+
+# Maximum number of Readwise updates in flight at once
+MAX_UPDATE_WORKERS = 8
+
+# Number of CSV rows written per call to the CSV writer
+CSV_WRITE_BATCH_SIZE = 500
+
+
+class RateLimiter:
+    """
+    Token bucket that paces requests to a given number per minute, so they are spread out
+    before the API starts answering with 429s.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.refill_rate = requests_per_minute / 60  # Tokens per second
+        self.capacity = max(1, self.refill_rate)  # Allow at most one second's worth of burst
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Takes a token and returns how many seconds the caller must wait before using it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.refill_rate)
+            self.last = now
+            self.tokens -= 1
+            # A negative balance is owed by this caller and paid back by waiting
+            return max(0, -self.tokens / self.refill_rate)
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        time.sleep(self._reserve())
+
+    async def acquire_async(self):
+        """
+        Waits without blocking the event loop until a request may be sent.
+        """
+        await asyncio.sleep(self._reserve())
+
+
+# Requests per minute allowed by Readwise and OpenAI
+readwise_limiter = RateLimiter(int(os.environ.get("READWISE_RPM", 240)))
+openai_limiter = RateLimiter(int(os.environ.get("OPENAI_RPM", 3500)))
+
+
+def tag_cache_key(highlight_text):
+    """
+    Returns the cache key for a highlight, covering the model and prompt version used to tag it.
+    """
+    return hashlib.sha256(f"{OPENAI_MODEL}:{PROMPT_VERSION}:{highlight_text}".encode()).hexdigest()
 
-# Maximum number of retries
-MAX_RETRIES = 5
 
-def generate_tags_from_openai(highlight_text):
+async def generate_tags_batch(highlight_texts, strict=False):
     """
-    Use OpenAI to generate up to 3 tags for a given highlight using the chat completion model.
+    Use OpenAI to generate up to 3 tags for each of the given highlights in a single chat completion.
+    Returns one tag list per highlight, in the same order, keeping only tags from the allowlist,
+    or None for every highlight if the request failed or the reply had the wrong length.
+    With strict set, the stricter system prompt is used.
     """
     try:
-        prompt = f'Generate up to 3 high-level relevant tags for the following highlight: "{highlight_text}". They should be separated by commas and not have hashes. Use British English. They should be restricted to: Economics, Technology, Startups, Science, Physics, Biology, Chemistry, Entrepreneurship, Liberalism, Philosophy, Environment, Religion, Politics, History, Psychology, Sociology, Statistics, United Kingdom, Quotes, Film, Music, Marketing, Politics, Personal Finance, Design, CBT, Lifetips, Europe, United States, Critical Thinking, IdPol, Health, Finance, Agriculture, Productivity, and Literature.'
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
+        numbered_highlights = "\n".join(f'{i}. "{text}"' for i, text in enumerate(highlight_texts, start=1))
+        await openai_limiter.acquire_async()
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
             messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt},
+                {"role": "system", "content": STRICT_SYSTEM_PROMPT if strict else SYSTEM_PROMPT},
+                {"role": "user", "content": numbered_highlights},
             ],
-            max_tokens=50,
+            max_tokens=30 * len(highlight_texts),
             temperature=0.5,
+            response_format=TAGS_RESPONSE_FORMAT,
         )
         # Extract the tags from the response content
-        tags_text = response.choices[0].message.content.strip()
-        tags = [tag.strip() for tag in tags_text.split(",") if tag.strip()]
-        return tags
+        tag_lists = json.loads(response.choices[0].message.content)["tags"]
+        if len(tag_lists) != len(highlight_texts):
+            # A reply of the wrong length can't be lined up with the highlights, so it is a failure
+            logger.warning("Expected tags for %d highlights but got %d.", len(highlight_texts), len(tag_lists))
+            return [None for _ in highlight_texts]
+        # The schema should already guarantee this, but never let a stray tag reach the CSV
+        return [[tag for tag in tags if tag in ALLOWED_TAG_SET][:3] for tags in tag_lists]
     except Exception as e:
-        print(f"Error generating tags: {e}")
-        return []
+        logger.error("Error generating tags: %s", e)
+        return [None for _ in highlight_texts]
+
+
+def duplicate_key(highlight_text):
+    """
+    Returns a compact key shared by highlights whose normalized text is identical.
+    """
+    return hashlib.blake2b(normalize_text(highlight_text).encode(), digest_size=8).digest()
+
+
+async def generate_missing_tags(highlights, seen):
+    """
+    Generate tags for the given highlights in batches of BATCH_SIZE, with at most
+    MAX_CONCURRENT_REQUESTS batches in flight. Highlights tagged on a previous run are
+    served from the on-disk cache, and duplicates of a highlight already tagged in this
+    run reuse its tags from seen. Returns the tag lists in the same order as the highlights.
+    """
+    keys = [duplicate_key(highlight["text"]) for highlight in highlights]
+
+    # Only the first highlight with each normalized text needs tagging
+    uncached = []
+    pending = set()
+    for key, highlight in zip(keys, highlights):
+        if key in seen or key in pending:
+            continue
+        cache_key = tag_cache_key(highlight["text"])
+        if cache_key in tag_cache:
+            seen[key] = tag_cache[cache_key]
+        else:
+            pending.add(key)
+            uncached.append((key, cache_key, highlight["text"]))
+
+    batches = [uncached[i:i + BATCH_SIZE] for i in range(0, len(uncached), BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def generate_with_limit(batch):
+        texts = [text for _, _, text in batch]
+        async with semaphore:
+            tag_lists = await generate_tags_batch(texts)
+
+            # Retry highlights the model answered without a valid tag once, with the stricter
+            # prompt. Failed requests (None), including wrong-length replies, are not retried
+            # straight away, so errors don't double the request volume.
+            retry_indexes = [i for i, tags in enumerate(tag_lists) if tags == []]
+            if retry_indexes:
+                retried = await generate_tags_batch([texts[i] for i in retry_indexes], strict=True)
+                for i, tags in zip(retry_indexes, retried):
+                    tag_lists[i] = tags
+        for (key, cache_key, _), tags in zip(batch, tag_lists):
+            # Failed requests are left out so duplicates and the next run retry them. A highlight
+            # that a well-formed reply left without a valid tag, even after the strict retry, is
+            # cached as empty so reruns don't pay for it twice again.
+            if tags is not None:
+                seen[key] = tags
+                tag_cache[cache_key] = tags
+
+    await asyncio.gather(*[generate_with_limit(batch) for batch in batches])
+    return [seen.get(key, []) for key in keys]
 
 
 def normalize_text(text):
@@ -56,20 +280,17 @@ def normalize_text(text):
     return text.strip().lower()
 
 
-def find_matching_highlight(book, highlight_text):
+def get_prefix_index(book):
     """
-    Finds a matching highlight in the book based on partial text matching.
+    Returns the book's highlights keyed by the first 100 characters of their normalized text.
+    The index is built on first use and cached on the book.
     """
-    normalized_highlight_text = normalize_text(highlight_text)
-    for highlight in book["highlights"]:
-        normalized_book_highlight = normalize_text(highlight["text"])
-        
-        # Perform partial matching (first 100 characters)
-        if normalized_highlight_text[:100] in normalized_book_highlight:
-            return highlight
-
-    # No match found
-    return None
+    if "_index" not in book:
+        book["_index"] = {}
+        for highlight in book["highlights"]:
+            # Keep the first highlight when two share a prefix, as the old linear scan did
+            book["_index"].setdefault(normalize_text(highlight["text"])[:100], highlight)
+    return book["_index"]
 
 
 def load_updated_highlight_ids():
@@ -78,124 +299,367 @@ def load_updated_highlight_ids():
     """
     if os.path.exists(success_log_file):
         with open(success_log_file, "r") as f:
-            return {line.strip() for line in f.readlines()}
+            return {int(line) for line in f if line.strip()}
     return set()
 
 
-def log_successful_update(highlight_id):
+# Serializes writes to the success log from the update worker threads
+log_lock = threading.Lock()
+
+
+def log_successful_update(log_file, highlight_id):
     """
-    Log a successfully updated highlight ID to the file.
+    Log a successfully updated highlight ID to the open log file.
     """
-    with open(success_log_file, "a") as f:
-        f.write(f"{highlight_id}\n")
+    with log_lock:
+        log_file.write(f"{highlight_id}\n")
 
 
-def update_highlight_tags(highlight_id, tags):
+def update_highlight_tags(highlight_id, tags, log_file):
     """
-    Updates the tags for a specific highlight using Readwise API with exponential backoff.
+    Updates the tags for a specific highlight using Readwise API, recording successful
+    updates in the given log file. Transient errors are retried by the session.
     """
     url = f"https://readwise.io/api/v2/highlights/{highlight_id}/"
     payload = {"tags": [{"name": tag} for tag in tags]}
-    retries = 0
-    backoff = 2  # Start with 2 seconds
 
-    while retries < MAX_RETRIES:
-        try:
-            # Send a PATCH request to update the highlight
-            response = requests.patch(url, headers=headers, json=payload)
-
-            if response.status_code == 200:
-                print(f"Successfully updated highlight {highlight_id} with tags: {tags}")
-                log_successful_update(highlight_id)  # Log the successful update
-                return True
-            elif response.status_code == 429:
-                # Handle rate limiting
-                print(f"Rate limited. Waiting for {backoff} seconds before retrying.")
-                time.sleep(backoff)
-                backoff *= 2  # Double the backoff time
-                retries += 1
-            else:
-                # Handle other errors
-                print(f"Failed to update highlight {highlight_id}. Status code: {response.status_code}")
-                print(response.text)
-                return False
-        except requests.exceptions.RequestException as e:
-            print(f"Request error: {e}")
-            return False
+    try:
+        # Send a PATCH request to update the highlight
+        readwise_limiter.acquire()
+        response = session.patch(url, json=payload)
 
-    print(f"Max retries exceeded for highlight {highlight_id}.")
-    return False
+        if response.status_code == 200:
+            logger.info("Successfully updated highlight %s with tags: %s", highlight_id, tags)
+            log_successful_update(log_file, highlight_id)  # Log the successful update
+            return True
+        else:
+            # Handle other errors
+            logger.error(
+                "Failed to update highlight %s. status=%s body=%.500s", highlight_id, response.status_code, response.text
+            )
+            return False
+    except requests.exceptions.RetryError:
+        logger.error("Max retries exceeded for highlight %s.", highlight_id)
+        return False
+    except requests.exceptions.RequestException as e:
+        logger.error("Request error: %s", e)
+        return False
 
 
-def fetch_highlights():
+def iter_highlights():
     """
-    Fetch highlights from Readwise and return them, with pagination support.
+    Fetch highlights from Readwise page by page and yield them one book at a time,
+    so only a single page of the export is held in memory.
     """
     url = "https://readwise.io/api/v2/export/"
     next_page_cursor = None
-    all_highlights = []
 
     while True:
         params = {"pageCursor": next_page_cursor} if next_page_cursor else {}
-        response = requests.get(url, headers=headers, params=params)
+        try:
+            response = session.get(url, params=params)
+        except requests.exceptions.RetryError:
+            logger.error("Max retries exceeded fetching export data.")
+            break
+        except requests.exceptions.RequestException as e:
+            logger.error("Request error: %s", e)
+            break
 
         if response.status_code == 200:
-            data_export = response.json()
-            all_highlights.extend(data_export.get("results", []))
+            data_export = orjson.loads(response.content)
+            yield from data_export.get("results", [])
             next_page_cursor = data_export.get("nextPageCursor")
             if not next_page_cursor:
                 break  # No more pages
         else:
-            print(f"Failed to fetch export data. Status code: {response.status_code}")
-            print(response.text)
+            logger.error("Failed to fetch export data. status=%s body=%.500s", response.status_code, response.text)
             break
 
-    return all_highlights
+
+def embedding_cache_key(text):
+    """
+    Returns the cache key for the embedding of a text under EMBEDDING_MODEL.
+    """
+    return hashlib.sha256(f"{EMBEDDING_MODEL}:{text}".encode()).hexdigest()
+
+
+def iter_embedding_batches(items):
+    """
+    Splits (key, text) pairs into batches the embeddings endpoint accepts: at most
+    EMBEDDING_BATCH_SIZE inputs and EMBEDDING_MAX_BATCH_CHARS characters per request.
+    """
+    batch = []
+    batch_chars = 0
+    for key, text in items:
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_chars + len(text) > EMBEDDING_MAX_BATCH_CHARS):
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append((key, text))
+        batch_chars += len(text)
+    if batch:
+        yield batch
+
+
+async def embed_texts(texts):
+    """
+    Returns unit-length embeddings for the texts, one row per text. Texts embedded on a
+    previous run are served from the on-disk cache, the rest are sent in batches sized by
+    iter_embedding_batches. Texts whose batch failed get a zero row, which never matches.
+    """
+    keys = [embedding_cache_key(text) for text in texts]
+    # Overlong highlights are truncated, since the API rejects inputs over its token limit.
+    # The API also rejects empty input, so blank highlights are embedded as a single space.
+    missing = {
+        key: text[:EMBEDDING_MAX_INPUT_CHARS] or " "
+        for key, text in zip(keys, texts)
+        if key not in embedding_cache
+    }
+
+    for batch in iter_embedding_batches(missing.items()):
+        try:
+            await openai_limiter.acquire_async()
+            response = await client.embeddings.create(model=EMBEDDING_MODEL, input=[text for _, text in batch])
+        except Exception as e:
+            # Only this batch goes without embeddings; the others can still match
+            logger.error("Error embedding %d highlights: %s", len(batch), e)
+            continue
+        for (key, _), item in zip(batch, response.data):
+            embedding_cache[key] = np.array(item.embedding, dtype=np.float32)
+
+    zeros = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    vectors = np.stack([embedding_cache[key] if key in embedding_cache else zeros for key in keys])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+async def find_semantic_matches(unmatched):
+    """
+    For each (books, highlight_text) pair, returns the highlight in those books whose embedding
+    has the highest cosine similarity with the text, or None if none reaches SIMILARITY_THRESHOLD.
+    """
+    candidate_books = list({id(book): book for books, _ in unmatched for book in books}.values())
+    book_texts = [highlight["text"] for book in candidate_books for highlight in book["highlights"]]
+
+    vectors = await embed_texts(book_texts + [text for _, text in unmatched])
+
+    # Give each book the rows for its own highlights
+    offset = 0
+    for book in candidate_books:
+        book["_embeddings"] = vectors[offset:offset + len(book["highlights"])]
+        offset += len(book["highlights"])
+
+    matches = []
+    for (books, _), query in zip(unmatched, vectors[offset:]):
+        best_highlight, best_score = None, SIMILARITY_THRESHOLD
+        for book in books:
+            if not book["highlights"]:
+                continue
+            scores = book["_embeddings"] @ query
+            best = int(np.argmax(scores))
+            if scores[best] >= best_score:
+                best_highlight, best_score = book["highlights"][best], scores[best]
+        matches.append(best_highlight)
+    return matches
 
 
 def update_tags_from_csv():
     """
     Reads the CSV file and updates the corresponding highlights with new tags.
     """
-    highlights_data = fetch_highlights()
+    # Collect the titles mentioned in the CSV so books it doesn't touch are never kept
+    with open(csv_file, mode="r", encoding="utf-8") as file:
+        csv_titles = {row["Book Title"] for row in csv.DictReader(file)}
+
+    # Index those books by title once so each CSV row is a dictionary lookup
+    title_to_books = {}
+    for book in iter_highlights():
+        if book["title"] in csv_titles:
+            title_to_books.setdefault(book["title"], []).append(book)
 
     # Load the IDs of already updated highlights from the log file
     updated_highlight_ids = load_updated_highlight_ids()
 
+    # Collect the updates first so they can be sent in parallel. They are keyed by highlight ID
+    # so two rows matching the same highlight don't race; the later CSV row wins.
+    pending_updates = {}
+
+    def queue_update(row_number, highlight, tags):
+        # Skip the highlight if it has already been updated
+        if highlight["id"] in updated_highlight_ids:
+            logger.info("Skipping already updated highlight %s.", highlight["id"])
+            return
+        previous = pending_updates.get(highlight["id"])
+        if previous:
+            logger.warning(
+                "CSV rows %d and %d both match highlight %s; keeping row %d.",
+                previous[0], row_number, highlight["id"], max(previous[0], row_number),
+            )
+            if previous[0] > row_number:
+                return
+        pending_updates[highlight["id"]] = (row_number, tags)
+
+    # Rows whose text no longer matches a highlight of their book exactly
+    unmatched = []
+    unmatched_rows = []
+
     with open(csv_file, mode="r", encoding="utf-8") as file:
         reader = csv.DictReader(file)
-        for row in reader:
+        for row_number, row in enumerate(reader, start=2):  # Row 1 is the header
             title = row["Book Title"]
             highlight_text = row["Highlight"]
             tags = row["Tags"].split(", ")
 
+            books = title_to_books.get(title, [])
+            prefix = normalize_text(highlight_text)[:100]
+
             matching_highlight = None
-            for book in highlights_data:
-                if book["title"] == title:
-                    matching_highlight = find_matching_highlight(book, highlight_text)
-                    if matching_highlight:
-                        break
+            for book in books:
+                matching_highlight = get_prefix_index(book).get(prefix)
+                if matching_highlight:
+                    break
 
             if matching_highlight:
-                highlight_id = matching_highlight["id"]
-
-                # Skip the highlight if it has already been updated
-                if str(highlight_id) in updated_highlight_ids:
-                    print(f"Skipping already updated highlight {highlight_id}.")
-                    continue
+                queue_update(row_number, matching_highlight, tags)
+            elif books:
+                unmatched.append((books, highlight_text))
+                unmatched_rows.append((row_number, tags))
+            else:
+                logger.warning("No matching highlight found for: %s", highlight_text)
+                logger.warning("No Readwise book titled: %s", title)
 
-                # Update the highlight's tags
-                update_highlight_tags(highlight_id, tags)
+    # Fall back to embedding similarity for rows that were edited or reformatted
+    if unmatched:
+        matches = asyncio.run(find_semantic_matches(unmatched))
+        for (books, highlight_text), (row_number, tags), matching_highlight in zip(unmatched, unmatched_rows, matches):
+            if matching_highlight:
+                queue_update(row_number, matching_highlight, tags)
             else:
                 # Log the text comparison for debugging
-                print(f"No matching highlight found for: {highlight_text}")
+                logger.warning("No matching highlight found for: %s", highlight_text)
 
-                # Print comparison logs
-                print(f"Tried to match CSV highlight: {highlight_text}")
-                for book in highlights_data:
+                # Log comparisons against the highlights of the same book at debug level
+                logger.debug("Tried to match CSV highlight: %s", highlight_text)
+                for book in books:
                     for highlight in book["highlights"]:
-                        print(f"Compared with Readwise highlight: {highlight['text'][:100]}")
+                        logger.debug("Compared with Readwise highlight: %.100s", highlight["text"])
+
+    # Update the highlights' tags, paced by the Readwise rate limiter. The log is opened once
+    # and line-buffered so every successful update is on disk even if the run is interrupted.
+    with open(success_log_file, "a", buffering=1) as log_file:
+        with ThreadPoolExecutor(max_workers=MAX_UPDATE_WORKERS) as executor:
+            updates = [(highlight_id, tags) for highlight_id, (_, tags) in pending_updates.items()]
+            list(executor.map(lambda update: update_highlight_tags(*update, log_file), updates))
+
+
+async def tag_and_write_books(books, writer, seen):
+    """
+    Generates tags for the highlights in the given books that have fewer than 3,
+    then writes the books to the CSV writer in order.
+    seen maps already tagged highlight texts to their tags across calls.
+    """
+    # Collect every highlight that needs tags so the OpenAI requests can overlap
+    needing_tags = [
+        highlight
+        for book in books
+        for highlight in book["highlights"]
+        if len(highlight["tags"]) < 3
+    ]
+    generated_tags = await generate_missing_tags(needing_tags, seen)
+    new_tags = {highlight["id"]: tags for highlight, tags in zip(needing_tags, generated_tags)}
+
+    # Rows are written in large batches rather than one small write each
+    rows = []
+    for book in books:
+        title = book["title"]
+        for highlight in book["highlights"]:
+            tags = [tag["name"] for tag in highlight["tags"]]
+            for tag in new_tags.get(highlight["id"], []):
+                if tag not in tags:
+                    tags.append(tag)
+
+            rows.append([title, highlight["text"], ", ".join(tags)])
+            if len(rows) >= CSV_WRITE_BATCH_SIZE:
+                writer.writerows(rows)
+                rows = []
+
+            logger.debug("%s: %s", title, ", ".join(tags))
+
+    writer.writerows(rows)
+
+
+def build_docx_from_csv(csv_path, out_path):
+    """
+    Builds the Word document from the exported CSV, with one bold title per run of
+    consecutive rows from the same book, followed by each highlight and its tags.
+    """
+    document = Document()
+    current_title = None
+
+    with open(csv_path, mode="r", newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        next(reader, None)  # Skip the header
+        for title, highlight_text, tags in reader:
+            if title != current_title:
+                document.add_paragraph().add_run(title).bold = True
+                current_title = title
+
+            document.add_paragraph(highlight_text)
+            document.add_paragraph().add_run(f"Tags: {tags}").italic = True
 
+    document.save(out_path)
+
+
+async def export_highlights_with_tags():
+    """
+    Streams all highlights from Readwise, generates tags for those with fewer than 3,
+    and saves them to the CSV file as each group of books is tagged.
+    """
+    with open(csv_file, mode="w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Book Title", "Highlight", "Tags"])
+
+        # Tags generated this run, keyed by normalized highlight text
+        seen = {}
+
+        # Buffer books only until there is enough work to keep every concurrent request busy
+        pending_books = []
+        pending_count = 0
+        for book in iter_highlights():
+            pending_books.append(book)
+            pending_count += sum(1 for highlight in book["highlights"] if len(highlight["tags"]) < 3)
+
+            if pending_count >= BATCH_SIZE * MAX_CONCURRENT_REQUESTS:
+                await tag_and_write_books(pending_books, writer, seen)
+                file.flush()  # Keep everything tagged so far if the run is interrupted
+                pending_books = []
+                pending_count = 0
+
+        await tag_and_write_books(pending_books, writer, seen)
+
+
+parser = argparse.ArgumentParser(description="Tag Readwise highlights with OpenAI.")
+parser.add_argument(
+    "step",
+    nargs="?",
+    choices=["export", "update"],
+    default="update",
+    help="'export' writes highlights with generated tags to the CSV and DOCX files, "
+    "'update' pushes the tags from the CSV back to Readwise (default)",
+)
+parser.add_argument("--verbose", action="store_true", help="also log every exported highlight and failed match comparisons")
+parser.add_argument("--no-docx", action="store_true", help="skip building the DOCX file after the export")
+args = parser.parse_args()
+
+# Libraries such as httpx only report warnings and errors; this script's own progress is
+# logged at INFO, or DEBUG with --verbose
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
 
 # Start the process
-update_tags_from_csv()
+if args.step == "export":
+    asyncio.run(export_highlights_with_tags())
+    if not args.no_docx:
+        build_docx_from_csv(csv_file, docx_file)
+else:
+    update_tags_from_csv()